@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Finds "flaps": waves of UFO reports, with several sightings close together in
+both space and time.
+
+Uses density-based clustering (DBSCAN) in space-time: two sightings are
+neighbours if they are within <eps_km> of each other AND within <eps_days> of
+each other. A sighting with at least <min_sightings> neighbours (counting
+itself) is a core sighting; clusters are the core sightings connected through
+their neighbours, together with any other sightings that neighbour them. The
+rest are noise (flap -1).
+
+Neighbours are found with a grid of space-time cells <eps_km> by <eps_km> by
+<eps_days> in size, so each sighting is only compared with those in its own
+and the 26 adjacent cells, and everything is done with numpy arrays rather
+than Python loops.
+
+Author: Richard Law
+Contact: richard.m.law@gmail.com
+'''
+
+from datetime import date
+
+import numpy as np
+from geojson import (Point, Feature, FeatureCollection)
+
+EARTH_RADIUS_KM = 6371.0
+
+# Number of sightings whose candidate neighbours are compared at once; bounds
+# memory use when sightings are densely packed
+CHUNK_SIZE = 100000
+
+
+def middle(longitudes, latitudes):
+    '''
+    Returns the mean (longitude, latitude) of the given points, treating
+    longitudes either side of the antimeridian (e.g. the Chatham Islands) as
+    neighbours
+    '''
+    if not len(longitudes):
+        return 0.0, 0.0
+    return float((np.asarray(longitudes) % 360.0).mean()), \
+        float(np.mean(latitudes))
+
+
+def project(longitudes, latitudes, origin=None):
+    '''
+    Returns approximate x and y coordinates in kilometres, using an
+    equirectangular projection about <origin> (longitude, latitude), by default
+    the `middle` of the points. Distances are true north-south everywhere, and
+    east-west at the latitude of the origin; across all of New Zealand they are
+    within about 10% east-west, and much closer within any one region.
+    '''
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    if origin is None:
+        origin = middle(longitudes, latitudes)
+    offsets = (longitudes - origin[0] + 180.0) % 360.0 - 180.0
+    x = EARTH_RADIUS_KM * np.radians(offsets) * np.cos(np.radians(origin[1]))
+    y = EARTH_RADIUS_KM * np.radians(latitudes)
+    return x, y
+
+
+def neighbour_pairs(x, y, days, eps_km, eps_days, chunk_size=CHUNK_SIZE):
+    '''
+    Returns two arrays (i, j) of the indices of every pair of distinct
+    space-time neighbours, in both directions
+    '''
+    cells = np.column_stack([
+        np.floor(x / eps_km), np.floor(y / eps_km),
+        np.floor(days / float(eps_days))
+    ]).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # Leave room for the -1 offsets
+    extent = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * extent[1] + cells[:, 1]) * extent[2] + cells[:, 2]
+
+    # Work in cell order, so that the lookups below are in sorted order too
+    order = np.argsort(keys, kind='mergesort')
+    keys, x, y, days = keys[order], x[order], y[order], days[order]
+    unique_keys, starts, counts = np.unique(
+        keys, return_index=True, return_counts=True)
+
+    # Each pair of neighbouring cells only needs comparing once: the cell
+    # itself, and the 13 adjacent cells with a larger key
+    offsets = [(dx * extent[1] + dy) * extent[2] + dt
+               for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dt in (-1, 0, 1)]
+    offsets = [offset for offset in offsets if offset >= 0]
+
+    pairs_i, pairs_j = [], []
+    for chunk in range(0, len(keys), chunk_size):
+        points = np.arange(chunk, min(chunk + chunk_size, len(keys)))
+        for offset in offsets:
+            # Find each point's neighbouring cell (if it has any sightings)
+            target = keys[points] + offset
+            found = np.searchsorted(unique_keys, target)
+            found = np.minimum(found, len(unique_keys) - 1)
+            hit = unique_keys[found] == target
+            source = points[hit]
+            first, number = starts[found[hit]], counts[found[hit]]
+            if not number.sum():
+                continue
+            # Expand to every (point, candidate in that cell) pair
+            i = np.repeat(source, number)
+            ends = np.cumsum(number)
+            j = np.repeat(first - ends + number, number) + np.arange(ends[-1])
+            near = ((np.abs(days[i] - days[j]) <= eps_days) &
+                    ((x[i] - x[j])**2 + (y[i] - y[j])**2 <= eps_km**2))
+            if not offset:
+                near &= i < j
+            pairs_i.append(i[near])
+            pairs_j.append(j[near])
+    if not pairs_i:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    i, j = order[np.concatenate(pairs_i)], order[np.concatenate(pairs_j)]
+    return np.concatenate([i, j]), np.concatenate([j, i])
+
+
+def connected_components(count, i, j):
+    '''
+    Labels <count> nodes by the connected component they belong to, given
+    edges (i, j), using the smallest node index in each component as its label
+    '''
+    labels = np.arange(count)
+    while True:
+        previous = labels.copy()
+        # Hook: point the root of each edge's larger label at the smaller one
+        label_i, label_j = labels[i], labels[j]
+        np.minimum.at(labels, label_i, label_j)
+        np.minimum.at(labels, label_j, label_i)
+        # Shortcut: jump pointers until every node points straight at a root
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def find_flaps(longitudes, latitudes, days, eps_km=25.0, eps_days=3,
+               min_sightings=3):
+    '''
+    Clusters sightings in space-time. <days> is the date of each sighting as a
+    number of days (e.g. a proleptic Gregorian ordinal). Returns an array with
+    the flap number of each sighting, counting from 0, or -1 for noise.
+    '''
+    days = np.asarray(days, dtype=float)
+    count = len(days)
+    if not count:
+        return np.array([], dtype=np.int64)
+    x, y = project(longitudes, latitudes)
+    i, j = neighbour_pairs(x, y, days, eps_km, eps_days)
+
+    core = np.bincount(i, minlength=count) + 1 >= min_sightings
+    both_core = core[i] & core[j]
+    labels = connected_components(count, i[both_core], j[both_core])
+
+    # A border sighting joins the flap of (any) core sighting it neighbours
+    border = ~core[i] & core[j]
+    flap_of = np.full(count, -1, dtype=np.int64)
+    flap_of[core] = labels[core]
+    flap_of[i[border]] = labels[j[border]]
+
+    # Renumber flaps 0, 1, 2...
+    members = flap_of >= 0
+    _, flaps = np.unique(flap_of[members], return_inverse=True)
+    flap_of[members] = flaps
+    return flap_of
+
+
+def summarise_flaps(longitudes, latitudes, days, flaps):
+    '''
+    Returns a list of dictionaries summarising each flap: its number, the
+    number of sightings, its centroid, the first and last day, and the
+    distance of the furthest sighting from the centroid (km)
+    '''
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    days = np.asarray(days, dtype=float)
+    flaps = np.asarray(flaps)
+    members = flaps >= 0
+    if not members.any():
+        return []
+    flaps, longitudes, latitudes, days = (flaps[members], longitudes[members],
+                                          latitudes[members], days[members])
+    number = flaps.max() + 1
+    sizes = np.bincount(flaps, minlength=number)
+    centroid_lon = np.bincount(flaps, longitudes, minlength=number) / sizes
+    centroid_lat = np.bincount(flaps, latitudes, minlength=number) / sizes
+    first = np.full(number, np.inf)
+    last = np.full(number, -np.inf)
+    np.minimum.at(first, flaps, days)
+    np.maximum.at(last, flaps, days)
+    origin = middle(longitudes, latitudes)
+    x, y = project(longitudes, latitudes, origin)
+    centroid_x, centroid_y = project(centroid_lon[flaps], centroid_lat[flaps],
+                                     origin)
+    radius = np.zeros(number)
+    np.maximum.at(radius, flaps,
+                  np.hypot(x - centroid_x, y - centroid_y))
+    return [{
+        'flap': int(flap),
+        'sightings': int(sizes[flap]),
+        'longitude': float(centroid_lon[flap]),
+        'latitude': float(centroid_lat[flap]),
+        'first_day': int(first[flap]),
+        'last_day': int(last[flap]),
+        'span_days': int(last[flap] - first[flap]),
+        'span_km': round(float(radius[flap]), 1)
+    } for flap in range(number)]
+
+
+def detect_flaps(list_of_UFOSighting_objects, **kwargs):
+    '''
+    Sets the `flap` of each geocoded and dated UFOSighting ("" if it isn't part
+    of one), and returns the flap summaries as a GeoJSON FeatureCollection of
+    their centroids. <kwargs> are passed on to `find_flaps`.
+
+    A flap is identified by the `identifier()` of its earliest sighting, so
+    that it keeps its id from run to run, whatever order the sightings come in
+    and whatever other flaps come and go.
+    '''
+    placed = sorted([ufo for ufo in list_of_UFOSighting_objects
+                     if ufo is not None and ufo.haslocation and ufo.date],
+                    key=lambda ufo: (ufo.date, ufo.identifier()))
+    longitudes = [ufo.longitude for ufo in placed]
+    latitudes = [ufo.latitude for ufo in placed]
+    days = [ufo.date.toordinal() for ufo in placed]
+    flaps = find_flaps(longitudes, latitudes, days, **kwargs)
+
+    # The sightings are in order, so the first of each flap is its earliest
+    members = flaps >= 0
+    numbers, first = np.unique(flaps[members], return_index=True)
+    ids = dict(zip(numbers, [placed[i].identifier()
+                             for i in np.flatnonzero(members)[first]]))
+    for ufo, flap in zip(placed, flaps):
+        ufo.flap = ids.get(flap, '')
+
+    features = []
+    for summary in summarise_flaps(longitudes, latitudes, days, flaps):
+        flap_id = ids[summary['flap']]
+        properties = {
+            'flap': flap_id,
+            'sightings': summary['sightings'],
+            'start': date.fromordinal(summary['first_day']).isoformat(),
+            'end': date.fromordinal(summary['last_day']).isoformat(),
+            'span_days': summary['span_days'],
+            'span_km': summary['span_km']
+        }
+        features.append(Feature(
+            id=flap_id,
+            geometry=Point((summary['longitude'], summary['latitude'])),
+            properties=properties))
+    return FeatureCollection(features)
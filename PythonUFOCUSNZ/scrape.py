@@ -18,6 +18,8 @@ import string
 import os
 import HTMLParser
 import multiprocessing
+import signal
+import hashlib
 
 # pylint: disable=import-error
 from BeautifulSoup import BeautifulSoup
@@ -29,6 +31,9 @@ from geopy.exc import GeocoderTimedOut
 import json
 from geojson import (Point, Feature, FeatureCollection)
 
+from flaps import detect_flaps
+from timeofday import (parse_time, is_clock_time)
+
 
 def handle_special_date_exception(date_string, exc):
     '''
@@ -308,6 +313,129 @@ def return_location_without_bracketed_clause(location,
     return pattern.sub('', location)
 
 
+# Geocode strategies: each takes the current location and the set of
+# candidate locations tried so far, and yields new locations to try
+# pylint: disable=unused-argument
+def as_is_strategy(location, candidates):
+    '''Tries the location just as it is'''
+    yield location
+
+
+AS_IS = 'as is'
+
+
+def conjunction_strategy(location, candidates):
+    '''Tries the location description, without leading conjunctions'''
+    return strip_conjunctions_at_start(location)
+
+
+def slash_strategy(location, candidates):
+    '''If there's a slash in the name, splits it into two attempts'''
+    for loc in candidates:
+        for sub in yield_locations_without_symbol(loc, '(\w*/[\w\s]*)', '/'):
+            yield sub
+
+
+def ampersand_strategy(location, candidates):
+    '''If there's an ampersand in the name, splits it into two attempts'''
+    for loc in candidates:
+        for sub in yield_locations_without_symbol(loc, '(\w*\s&amp;\s\w*)',
+                                                  '&amp;'):
+            yield sub.strip()
+
+
+def bracket_strategy(location, candidates):
+    '''Tries without a bracketed clause'''
+    for loc in candidates:
+        yield return_location_without_bracketed_clause(loc)
+
+
+def substitution_strategy(location, candidates):
+    '''Tries with some common substitutions or known errors'''
+    return substitutions_for_known_issues(candidates)
+
+
+def title_case_strategy(location, candidates):
+    '''Tries without non-title-case words, and without one-letter words'''
+    for loc in candidates:
+        yield return_location_without_non_title_case_and_short_words(loc)
+
+
+GEOCODE_STRATEGIES = [
+    ('conjunctions', conjunction_strategy),
+    ('slash', slash_strategy),
+    ('ampersand', ampersand_strategy),
+    ('brackets', bracket_strategy),
+    ('substitutions', substitution_strategy),
+    ('title case', title_case_strategy)
+]
+
+
+def classify_location(location):
+    '''
+    Classifies a raw location string by the simple features that decide which
+    geocode strategy is likely to work for it, e.g. "slash+brackets". Returns
+    "plain" for a location with none of them.
+    '''
+    if not location:
+        return 'plain'
+    location = location.strip()
+    islands = ['North Island', 'South Island', 'NI', 'SI', 'Nth Island',
+               'Sth Island', 'North Is', 'South Is']
+    features = []
+    if '/' in location:
+        features.append('slash')
+    if '&amp;' in location or '&' in location:
+        features.append('ampersand')
+    if '(' in location and ')' in location:
+        features.append('brackets')
+    if any(strip_nonalpha_at_end(location).endswith(i) for i in islands):
+        features.append('island')
+    if location.split(' ')[0] in ['of', 'to', 'and', 'from', 'between']:
+        features.append('conjunction')
+    return '+'.join(features) or 'plain'
+
+
+def order_geocode_strategies(location_class, strategy_stats,
+                             strategies=GEOCODE_STRATEGIES):
+    '''
+    Returns <strategies> ordered by how often each has been the one to succeed
+    for locations of <location_class>; ties keep their default order.
+    '''
+    wins = strategy_stats.get(location_class, {})
+    return sorted(strategies, key=lambda strategy: -wins.get(strategy[0], 0))
+
+
+def record_geocode_strategy(strategy_stats, sighting):
+    '''
+    Counts the strategy that successfully geocoded <sighting> against the class
+    of its location in <strategy_stats>
+    '''
+    if not sighting.geocoded_by:
+        return
+    wins = strategy_stats.setdefault(classify_location(sighting.location), {})
+    wins[sighting.geocoded_by] = wins.get(sighting.geocoded_by, 0) + 1
+
+
+def read_strategy_stats(path):
+    '''
+    Reads the geocode strategy counts saved by `write_strategy_stats`
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as infile:
+        return json.load(infile)
+
+
+def write_strategy_stats(strategy_stats, path):
+    '''
+    Saves geocode strategy counts to <path>, replacing it atomically
+    '''
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(strategy_stats, outfile, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
 # pylint: disable=no-init
 # pylint: disable=too-few-public-methods
 class Bcolors(object):
@@ -336,6 +464,8 @@ class UFOSighting(object):
         self.source = source  # Link to page
         self.date = parse_date(date)  # Python date
         self.time = time  # String time
+        # Minutes of the day, and confidence; see timeofday.py
+        self.time_start, self.time_end, self.time_confidence = parse_time(time)
         self.location = location  # String location (will be used in geocode)
         self.features = features
         self.description = description
@@ -346,6 +476,8 @@ class UFOSighting(object):
         self.haslocation = None  # Unknown state
         self.geocoded_to = ""
         self.geocode_attempts = 1
+        self.geocoded_by = ""  # Name of the successful geocode strategy
+        self.flap = ""  # Wave of sightings this is part of; see flaps.py
         self.already_attempted = set([])
 
     def __str__(self):
@@ -366,13 +498,29 @@ class UFOSighting(object):
         if not self.haslocation:
             return None
         return Feature(
+            id=self.identifier(),
             geometry=Point((self.longitude, self.latitude)),
             properties={
-                key: h.unescape(str(value)) for key, value in \
-                self.__dict__.items() if key not in exclude
+                # Integers (but not booleans) are kept as integers
+                key: value if isinstance(value, (int, long)) and \
+                not isinstance(value, bool) else h.unescape(str(value))
+                for key, value in self.__dict__.items() if key not in exclude
             }
         )
 
+    def identifier(self):
+        '''
+        Returns a stable identifier for this sighting, a hash of the source page
+        and its raw content (two witnesses' reports of the same event can share
+        a date, time and location). Used to key the geocode journal, and as the
+        GeoJSON feature id.
+        '''
+        key = '|'.join(
+            [str(prop) for prop in (self.source, self.date, self.time,
+                                    self.location, self.features,
+                                    self.description)])
+        return hashlib.sha1(key).hexdigest()
+
     def is_valid(self):
         '''
         Retutns boolean indicating whether or not an HTML actually has content
@@ -430,7 +578,7 @@ class UFOSighting(object):
             print Bcolors.FAIL + '← fail' + Bcolors.ENDC
         return None  # No result, but there are more options to try
 
-    def geocode(self, debug=False):
+    def geocode(self, debug=False, strategy_stats=None, max_attempts=25):
         '''
         Updates self.latitude and self.longitude if a geocode is successsful;
         otherwise leaves them as the default (None).
@@ -438,6 +586,10 @@ class UFOSighting(object):
         Returns False if the location could not be geocoded, returns True when
         the geocode is sucessful.
 
+        <strategy_stats> are the counts kept by `record_geocode_strategy`, and
+        are used to order the fallback strategies in GEOCODE_STRATEGIES. At most
+        <max_attempts> distinct locations are sent to the geocoder.
+
         Tip: use geocode=False when instantiating, and then do a batch geocode
         using multiple threads with multiprocessing!
         '''
@@ -446,9 +598,8 @@ class UFOSighting(object):
 
         location = self.location
 
-        # TODO:
-        # '12:00 am, New Zealand' -37.7894134 175.2850399
-        if location == '12:00 am':
+        # Sometimes the time ends up in the location, e.g. '12:00 am'
+        if is_clock_time(location):
             return None
 
         if debug:
@@ -489,63 +640,33 @@ class UFOSighting(object):
             if 'New Zealand' not in location:
                 location = location.strip() + ' New Zealand'
 
-        while True:
-
-            # Try the location description, without leading conjunctions
-            for loc in strip_conjunctions_at_start(location):
-                gc = self.attempt_geocode(loc)
-                if gc is not None:
-                    return gc
-
-            # If there's a slash in the name, split it into two attempts
-            attempts_copy = self.already_attempted.copy()
-            for loc in attempts_copy:
-                for loc in yield_locations_without_symbol(loc, '(\w*/[\w\s]*)',
-                                                          '/'):
+        # Try the strategies most likely to succeed for this kind of location
+        # first, giving up once the budget of geocoder queries is spent
+        strategies = order_geocode_strategies(
+            classify_location(self.location), strategy_stats or {})
+        while location.strip():
+
+            # Always try the location as it is first
+            for name, strategy in [(AS_IS, as_is_strategy)] + strategies:
+                candidates = self.already_attempted.copy()
+                candidates.add(location)
+                for loc in list(strategy(location, candidates)):
+                    if len(self.already_attempted) >= max_attempts:
+                        return False
                     gc = self.attempt_geocode(loc)
                     if gc is not None:
+                        if gc:
+                            # A strategy only earns credit for changing things
+                            changed = loc.split() != location.split()
+                            self.geocoded_by = name if changed else AS_IS
                         return gc
 
-            # If there's an ampersand in the name, split it into two attempts
-            attempts_copy = self.already_attempted.copy()
-            for loc in attempts_copy:
-                for loc in yield_locations_without_symbol(
-                        loc, '(\w*\s&amp;\s\w*)', '*'):
-                    gc = self.attempt_geocode(loc)
-                    if gc is not None:
-                        return gc
-
-            # Try without a bracketed clause
-            attempts_copy = self.already_attempted.copy()
-            for loc in attempts_copy:
-                gc = self.attempt_geocode(
-                    return_location_without_bracketed_clause(loc))
-                if gc is not None:
-                    return gc
-
-            # Try with some common substitutions or known errors:
-            attempts_copy = self.already_attempted.copy()
-            for loc in substitutions_for_known_issues(attempts_copy):
-                gc = self.attempt_geocode(loc)
-                if gc is not None:
-                    return gc
-
-            # Try again without non-title-case words,
-            # and without one-letter words
-            attempts_copy = self.already_attempted.copy()
-            for loc in attempts_copy:
-                loc = return_location_without_non_title_case_and_short_words(
-                    loc)
-                gc = self.attempt_geocode(loc)
-                if gc is not None:
-                    return gc
-
             self.geocode_attempts += 1
 
             # Remove the first word of the location for next attempt
             location = ' '.join(location.split(' ')[1:])
 
-            # While loop repeats
+        return False
 
 
 def get_all_sightings_as_list_of_UFOSighting_objects(link,
@@ -609,7 +730,9 @@ def export_ufos_to_csv(list_of_UFOSighting_objects):
     '''
     # Convert UFO objects to tuples
     all_sightings_as_tuples = [
-        ufo.__tuple__() for ufo in list_of_UFOSighting_objects
+        ufo.__tuple__() +
+        (ufo.time_start, ufo.time_end, ufo.time_confidence)
+        for ufo in list_of_UFOSighting_objects
     ]
 
     # Create a pandas DataFrame from the list of tuples
@@ -617,7 +740,8 @@ def export_ufos_to_csv(list_of_UFOSighting_objects):
         all_sightings_as_tuples,
         columns=[
             'Date', 'Time', 'Location', 'Geocoded As', 'Geocode Attempts',
-            'Latitude', 'Longitude', 'Features', 'Description'
+            'Latitude', 'Longitude', 'Features', 'Description', 'Time Start',
+            'Time End', 'Time Confidence'
         ])
 
     # Export the pandas DF to CSV
@@ -629,12 +753,49 @@ def export_ufos_to_csv(list_of_UFOSighting_objects):
     return None
 
 
-def export_ufos_to_geojson(list_of_UFOSighting_objects):
+def diff_feature_collections(previous, current):
+    '''
+    Compares two GeoJSON feature collections (as dictionaries) by feature id,
+    returning the features that were added, the ids of the features that were
+    removed, and the features that were modified between them. Features without
+    an id are ignored.
+    '''
+    previous = {f['id']: f for f in previous['features'] if 'id' in f}
+    current = {f['id']: f for f in current['features'] if 'id' in f}
+    added = [f for k, f in current.items() if k not in previous]
+    removed = [k for k in previous.keys() if k not in current]
+    modified = [
+        f for k, f in current.items() if k in previous and f != previous[k]
+    ]
+    return added, removed, modified
+
+
+def latest_change_set(changes_dir):
+    '''
+    Returns the highest number of the change sets in <changes_dir>, or 0
+    '''
+    if not os.path.isdir(changes_dir):
+        return 0
+    numbers = [int(name[:-len('.json')]) for name in os.listdir(changes_dir)
+               if re.match(r'^\d+\.json$', name)]
+    return max(numbers or [0])
+
+
+def export_ufos_to_geojson(list_of_UFOSighting_objects, directory=None):
     '''
     Given a list of all the UFO sightings found on the website as UFOSighting
     objects, exports them to GeoJSON. The list is sorted by date, because the
     leaflet timeslider doesn't sort on a key, and I can't work out how to do it
     in JavaScript. Therefore it also removes observations that don't have a date
+
+    Each export is also compared with the previous one, and the features that
+    were added, removed or modified (if any) are written as a numbered change
+    set to ufos_data_changes/, so that consumers can apply just those. The
+    number of the latest change set is recorded as the "sequence" of the
+    collection. Numbering carries on from the highest of that and the existing
+    change sets, so that none is ever overwritten, even if the GeoJSON is lost.
+
+    Writes to <directory>, by default the one this script is in.
     '''
     list_of_UFOSighting_objects = [
         l for l in list_of_UFOSighting_objects if l is not None
@@ -643,14 +804,72 @@ def export_ufos_to_geojson(list_of_UFOSighting_objects):
         l for l in list_of_UFOSighting_objects if l.date
     ]
     list_of_UFOSighting_objects.sort(key=lambda x: x.date, reverse=False)
+    if directory is None:
+        directory = os.path.dirname(__file__)
+    outpath = os.path.join(directory, 'ufos_data.geojson')
+    changes_dir = os.path.join(directory, 'ufos_data_changes')
+
+    previous = {'features': [], 'sequence': 0}
+    if os.path.exists(outpath):
+        with open(outpath, 'r') as infile:
+            previous = json.load(infile)
+    sequence = previous.get('sequence', 0)
+
     fc = FeatureCollection([
         ufo.__geojson__() for ufo in list_of_UFOSighting_objects
         if ufo.haslocation
     ])
-    with open(
-            os.path.join(os.path.dirname(__file__), 'ufos_data.geojson'),
-            'w') as outfile:
+    # Round trip, so that it compares like for like with what was read
+    fc = json.loads(json.dumps(fc))
+
+    added, removed, modified = diff_feature_collections(previous, fc)
+    if added or removed or modified:
+        sequence = max(sequence, latest_change_set(changes_dir)) + 1
+        if not os.path.isdir(changes_dir):
+            os.makedirs(changes_dir)
+        change_set = os.path.join(changes_dir, '{}.json'.format(sequence))
+        # Atomically, as below; consumers may be polling for the next one
+        with open(change_set + '.tmp', 'w') as outfile:
+            json.dump({
+                'sequence': sequence,
+                'added': added,
+                'removed': removed,
+                'modified': modified
+            }, outfile)
+        os.rename(change_set + '.tmp', change_set)
+    fc['sequence'] = sequence
+
+    # Replace the output atomically, so that readers (e.g. server.py) never
+    # see a half-written file
+    with open(outpath + '.tmp', 'w') as outfile:
         json.dump(fc, outfile)
+    os.rename(outpath + '.tmp', outpath)
+
+
+def export_flaps_to_geojson(flaps):
+    '''
+    Exports the flaps (waves of sightings) found by `detect_flaps`, a GeoJSON
+    FeatureCollection of their centroids, as a layer of their own.
+    '''
+    outpath = os.path.join(os.path.dirname(__file__), 'ufos_flaps.geojson')
+    with open(outpath + '.tmp', 'w') as outfile:
+        json.dump(flaps, outfile)
+    os.rename(outpath + '.tmp', outpath)
+
+
+# Geocode strategy counts, as seen by each geocoding worker process
+WORKER_STRATEGY_STATS = {}
+
+
+def init_geocode_worker(strategy_stats):
+    '''
+    Initialises a geocoding worker process with the strategy counts to use.
+    Workers ignore Ctrl-C: the main process handles it, and stops them.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # pylint: disable=global-statement
+    global WORKER_STRATEGY_STATS
+    WORKER_STRATEGY_STATS = strategy_stats
 
 
 def geocode_worker(sighting):
@@ -658,10 +877,114 @@ def geocode_worker(sighting):
     A single geocoding worker, to be run in its own wee process... and probably
     rate-limited
     '''
-    sighting.geocode(debug=True)
+    sighting.geocode(debug=True, strategy_stats=WORKER_STRATEGY_STATS)
+    return sighting
+
+
+# Seconds to wait for a geocode result at a time; waiting without a timeout
+# can't be interrupted with Ctrl-C in Python 2
+RESULT_WAIT = 1
+
+JOURNAL_FIELDS = ['latitude', 'longitude', 'haslocation', 'geocoded_to',
+                  'geocoded_by', 'geocode_attempts']
+
+
+def read_geocode_journal(path):
+    '''
+    Reads a geocode journal written by `append_to_geocode_journal`, returning
+    a dictionary of sighting identifier to recorded geocode result. A line that
+    cannot be parsed (e.g. one cut short by a crash) is ignored.
+    '''
+    journal, line = {}, ''
+    if not os.path.exists(path):
+        return journal
+    with open(path, 'r') as infile:
+        for line in infile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            journal[entry['id']] = entry
+    # Terminate a partial last line so that the next append starts cleanly
+    if line and not line.endswith('\n'):
+        with open(path, 'a') as outfile:
+            outfile.write('\n')
+    return journal
+
+
+def append_to_geocode_journal(journal_file, sighting):
+    '''
+    Appends the geocode result of <sighting> to the open <journal_file> as a
+    single line of JSON, and forces it to disk so that it survives a crash.
+    '''
+    entry = {field: getattr(sighting, field) for field in JOURNAL_FIELDS}
+    entry['id'] = sighting.identifier()
+    journal_file.write(json.dumps(entry) + '\n')
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+
+def restore_from_geocode_journal(sighting, entry):
+    '''
+    Restores the geocode result recorded in a journal <entry> to <sighting>
+    '''
+    for field in JOURNAL_FIELDS:
+        value = entry.get(field, getattr(sighting, field))
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        setattr(sighting, field, value)
     return sighting
 
 
+def geocode_with_journal(all_sightings, journal_path, processes=1,
+                         strategy_stats=None):
+    '''
+    Geocodes <all_sightings> in a pool of <processes> workers, appending each
+    result to the journal at <journal_path> as soon as it completes. Sightings
+    already in the journal are restored from it rather than geocoded again, so
+    an interrupted run can be resumed by simply running it again.
+
+    Newly geocoded sightings are counted in <strategy_stats>, if given.
+    '''
+    if strategy_stats is None:
+        strategy_stats = {}
+    journal = read_geocode_journal(journal_path)
+    results, pending = [], []
+    for sighting in all_sightings:
+        if sighting.identifier() in journal:
+            results.append(restore_from_geocode_journal(
+                sighting, journal[sighting.identifier()]))
+        else:
+            pending.append(sighting)
+    print 'Restored {} geocodes from journal, {} to go'.format(
+        len(results), len(pending))
+    if not pending:
+        return results
+
+    pool = multiprocessing.Pool(processes=processes,
+                                initializer=init_geocode_worker,
+                                initargs=(strategy_stats, ))
+    try:
+        geocoded = pool.imap_unordered(geocode_worker, pending)
+        with open(journal_path, 'a') as journal_file:
+            while True:
+                try:
+                    sighting = geocoded.next(RESULT_WAIT)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                append_to_geocode_journal(journal_file, sighting)
+                record_geocode_strategy(strategy_stats, sighting)
+                results.append(sighting)
+    finally:
+        # Also stops the workers promptly on Ctrl-C; the journal keeps what's
+        # been done
+        pool.terminate()
+        pool.join()
+    return results
+
+
 def main(debug=False):
     '''Main loop'''
 
@@ -705,8 +1028,6 @@ def main(debug=False):
 
     links = set([l['href'] for l in links])
 
-    # TODO caching
-
     # Flatten lists of UFOs for each link
     all_sightings = reduce(
         lambda x, y: x + y, [
@@ -714,12 +1035,27 @@ def main(debug=False):
                 link, geocode=False, debug=debug) for link in links
         ])
 
-    pool = multiprocessing.Pool(
-        processes=max(multiprocessing.cpu_count() - 2, 1))
-    results = pool.map(geocode_worker, all_sightings)
+    # Geocode results are journalled as they complete, so that an interrupted
+    # run picks up where it left off; delete the journal to geocode afresh.
+    # Which fallback strategies work is remembered between runs, too.
+    stats_path = os.path.join(
+        os.path.dirname(__file__), 'geocode_strategies.json')
+    strategy_stats = read_strategy_stats(stats_path)
+    try:
+        results = geocode_with_journal(
+            all_sightings,
+            os.path.join(os.path.dirname(__file__), 'geocode_journal.jsonl'),
+            processes=max(multiprocessing.cpu_count() - 2, 1),
+            strategy_stats=strategy_stats)
+    finally:
+        write_strategy_stats(strategy_stats, stats_path)
+
+    # Find waves of sightings, and note them against each sighting
+    flaps = detect_flaps(results)
 
     # export_ufos_to_csv(results)
     export_ufos_to_geojson(results)
+    export_flaps_to_geojson(flaps)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+A small, read-only HTTP service over the GeoJSON exported by scrape.py, so
+that the map and other tools can ask for just the sightings they need.
+
+    python PythonUFOCUSNZ/server.py [path/to/ufos_data.geojson] [port]
+
+GET /sightings takes any combination of:
+
+    bbox=minlon,minlat,maxlon,maxlat
+    start=YYYY-MM-DD, end=YYYY-MM-DD (inclusive)
+    q=keywords (all must appear in the location, time, features or description)
+    time=HH:MM-HH:MM (time of day, which may cross midnight, e.g. 21:00-02:00)
+    format=geojson (default) or json
+
+The dataset is loaded once into memory and indexed; it is swapped for the new
+one whenever the exporter writes new output.
+
+Author: Richard Law
+Contact: richard.m.law@gmail.com
+'''
+
+import sys
+import os
+import re
+import math
+import json
+import gzip
+import hashlib
+import bisect
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from timeofday import in_time_window
+
+# Size of the cells of the spatial index, in degrees
+CELL_SIZE = 0.5
+
+# Number of responses kept in each dataset's cache
+CACHE_SIZE = 256
+
+# Seconds between checks for new exporter output
+POLL_INTERVAL = 2
+
+TEXT_PROPERTIES = ['location', 'geocoded_to', 'time', 'features',
+                   'description']
+
+
+def tokenise(text):
+    '''
+    Returns the set of lower case words in <text>
+    '''
+    return set(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def cell(longitude, latitude):
+    '''
+    Returns the spatial index cell that a coordinate falls in
+    '''
+    return (int(longitude // CELL_SIZE), int(latitude // CELL_SIZE))
+
+
+class LRUCache(object):
+    '''
+    A thread-safe least-recently-used cache of at most <size> items
+    '''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the item cached under <key>, or None'''
+        with self.lock:
+            if key not in self.items:
+                return None
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        '''Caches <value> under <key>, evicting the least recently used'''
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class Dataset(object):
+    '''
+    An exported collection of sightings, with spatial, date and text indexes.
+    Immutable once loaded: new output is loaded as a new Dataset.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'r') as infile:
+            collection = json.load(infile)
+        self.features = collection['features']
+        self.version = '{}-{}'.format(
+            collection.get('sequence', 0), self.mtime)
+        self.cache = LRUCache()
+
+        self.grid = {}
+        self.dates = []
+        self.words = {}
+        for i, feature in enumerate(self.features):
+            lon, lat = feature['geometry']['coordinates'][:2]
+            self.grid.setdefault(cell(lon, lat), []).append(i)
+            properties = feature['properties']
+            if properties.get('date'):
+                self.dates.append((properties['date'][:10], i))
+            for prop in TEXT_PROPERTIES:
+                for word in tokenise(properties.get(prop) or u''):
+                    self.words.setdefault(word, set()).add(i)
+        self.dates.sort()
+        # Older exports don't have normalised times
+        self.time_starts = np.array(
+            [int(f['properties'].get('time_start', -1)) for f in self.features],
+            dtype=np.int32)
+        self.time_ends = np.array(
+            [int(f['properties'].get('time_end', -1)) for f in self.features],
+            dtype=np.int32)
+
+    def in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        '''Returns the indices of the features within the bounding box'''
+        (min_x, min_y), (max_x, max_y) = (cell(min_lon, min_lat),
+                                          cell(max_lon, max_lat))
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.grid):
+            # Cheaper to look at just the cells that have sightings
+            cells = [key for key in self.grid
+                     if min_x <= key[0] <= max_x and min_y <= key[1] <= max_y]
+        else:
+            cells = [(x, y) for x in xrange(min_x, max_x + 1)
+                     for y in xrange(min_y, max_y + 1)]
+        found = set()
+        for key in cells:
+            for i in self.grid.get(key, []):
+                lon, lat = self.features[i]['geometry']['coordinates'][:2]
+                if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                    found.add(i)
+        return found
+
+    def in_date_range(self, start=None, end=None):
+        '''
+        Returns the indices of the features dated between <start> and <end>
+        (YYYY-MM-DD strings, inclusive; either may be None)
+        '''
+        low = 0 if start is None else bisect.bisect_left(
+            self.dates, (start, -1))
+        high = len(self.dates) if end is None else bisect.bisect_right(
+            self.dates, (end, len(self.features)))
+        return set(i for _, i in self.dates[low:high])
+
+    def in_time_of_day(self, window_start, window_end):
+        '''
+        Returns the indices of the features seen during the time of day from
+        <window_start> to <window_end> (minutes of the day)
+        '''
+        return set(np.flatnonzero(in_time_window(
+            self.time_starts, self.time_ends, window_start, window_end)))
+
+    def matching(self, keywords):
+        '''Returns the indices of the features containing all <keywords>'''
+        found = None
+        for word in tokenise(keywords):
+            hits = self.words.get(word, set())
+            found = hits if found is None else found & hits
+        return found if found is not None else set(
+            xrange(len(self.features)))
+
+    def query(self, bbox=None, start=None, end=None, keywords=None,
+              time_of_day=None):
+        '''
+        Returns the features meeting all of the given criteria, in the order
+        of the export (which is by date)
+        '''
+        found = None
+        if bbox is not None:
+            found = self.in_bbox(*bbox)
+        if start is not None or end is not None:
+            hits = self.in_date_range(start, end)
+            found = hits if found is None else found & hits
+        if keywords:
+            hits = self.matching(keywords)
+            found = hits if found is None else found & hits
+        if time_of_day is not None:
+            hits = self.in_time_of_day(*time_of_day)
+            found = hits if found is None else found & hits
+        if found is None:
+            return list(self.features)
+        return [self.features[i] for i in sorted(found)]
+
+
+class DatasetWatcher(threading.Thread):
+    '''
+    Holds the current Dataset, and replaces it whenever the file it was loaded
+    from changes. Requests read `current` once, so they always see one whole
+    dataset, never a mixture of old and new.
+    '''
+
+    def __init__(self, path, interval=POLL_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.current = Dataset(path)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if os.path.getmtime(self.path) != self.current.mtime:
+                    self.current = Dataset(self.path)
+            # Keep serving the old dataset if the new one can't be read
+            except (OSError, IOError, ValueError, KeyError):
+                continue
+
+
+def parse_query(query_string):
+    '''
+    Parses the query string of a request into the keyword arguments of
+    Dataset.query and the response format. Raises ValueError if it is invalid.
+    '''
+    params = {k: v[-1] for k, v in parse_qs(query_string).items()}
+    criteria = {}
+    if 'bbox' in params:
+        bbox = [float(b) for b in params['bbox'].split(',')]
+        if len(bbox) != 4 or any(math.isinf(b) or math.isnan(b) for b in bbox):
+            raise ValueError('bbox must be minlon,minlat,maxlon,maxlat')
+        if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError('bbox minimums must not exceed its maximums')
+        # Nothing lies beyond the edges of the world
+        bbox = [max(bbox[0], -180.0), max(bbox[1], -90.0),
+                min(bbox[2], 180.0), min(bbox[3], 90.0)]
+        criteria['bbox'] = bbox
+    for key in ['start', 'end']:
+        if key in params:
+            if not re.match(r'^\d{4}-\d{2}-\d{2}$', params[key]):
+                raise ValueError('{} must be YYYY-MM-DD'.format(key))
+            criteria[key] = params[key]
+    if 'time' in params:
+        match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$',
+                         params['time'])
+        if not match:
+            raise ValueError('time must be HH:MM-HH:MM')
+        hours_minutes = [int(group) for group in match.groups()]
+        if max(hours_minutes[0::2]) > 23 or max(hours_minutes[1::2]) > 59:
+            raise ValueError('time must be between 00:00 and 23:59')
+        criteria['time_of_day'] = [hours_minutes[0] * 60 + hours_minutes[1],
+                                   hours_minutes[2] * 60 + hours_minutes[3]]
+    if 'q' in params:
+        criteria['keywords'] = params['q'].decode('utf8')
+    output_format = params.get('format', 'geojson')
+    if output_format not in ['geojson', 'json']:
+        raise ValueError('format must be geojson or json')
+    return criteria, output_format
+
+
+def render(features, output_format):
+    '''
+    Returns <features> as a GeoJSON FeatureCollection, or as a plain JSON list
+    of their properties (with id, longitude and latitude)
+    '''
+    if output_format == 'geojson':
+        return json.dumps({'type': 'FeatureCollection', 'features': features})
+    rows = []
+    for feature in features:
+        row = dict(feature['properties'])
+        row['id'] = feature.get('id')
+        row['longitude'], row['latitude'] = \
+            feature['geometry']['coordinates'][:2]
+        rows.append(row)
+    return json.dumps(rows)
+
+
+def gzipped(body):
+    '''Returns <body> gzip compressed'''
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as outfile:
+        outfile.write(body)
+    return buf.getvalue()
+
+
+class SightingsHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET /sightings queries from the dataset held by server.watcher
+    '''
+
+    def do_GET(self):
+        # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/sightings':
+            self.send_error(404)
+            return
+        try:
+            criteria, output_format = parse_query(url.query)
+        except ValueError, exc:
+            self.send_error(400, str(exc))
+            return
+
+        dataset = self.server.watcher.current
+        key = json.dumps([criteria, output_format], sort_keys=True)
+        # The response depends on nothing else, so a client that already has
+        # it can be told so without rendering it
+        etag = '"{}"'.format(hashlib.sha1(dataset.version + key).hexdigest())
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        cached = dataset.cache.get(key)
+        if cached is None:
+            body = render(dataset.query(**criteria), output_format)
+            cached = (body, gzipped(body))
+            dataset.cache.put(key, cached)
+        body, compressed = cached
+
+        self.send_response(200)
+        content_type = 'application/geo+json' if output_format == 'geojson' \
+            else 'application/json'
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = compressed
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SightingsServer(ThreadingMixIn, HTTPServer):
+    '''
+    Multi-threaded HTTP server over the sightings in the GeoJSON at <path>
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, address=('', 8001)):
+        HTTPServer.__init__(self, address, SightingsHandler)
+        self.watcher = DatasetWatcher(path)
+        self.watcher.start()
+
+    def server_close(self):
+        '''Closes the server, and stops watching for new output'''
+        HTTPServer.server_close(self)
+        self.watcher.stopped.set()
+        self.watcher.join()
+
+
+def main(path=None, port=8001):
+    '''Serves the exported sightings until interrupted'''
+    if path is None:
+        path = os.path.join(os.path.dirname(__file__), 'ufos_data.geojson')
+    server = SightingsServer(path, address=('', port))
+    print 'Serving {} on port {}'.format(path, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    ARGS = sys.argv[1:]
+    main(ARGS[0] if ARGS else None, int(ARGS[1]) if len(ARGS) > 1 else 8001)
+    exit(0)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Normalises the free-text time of a sighting ("approx 9.30pm", "between 10 and
+11 pm", "Late afternoon/early evening"...) into a time-of-day interval: the
+start and end minute of the day (0-1439), and a confidence. An interval that
+crosses midnight has a start later than its end. Times that can't be
+interpreted are recorded as -1, -1, TIME_UNKNOWN.
+
+Being plain integers, these can be filtered and counted with numpy instead of
+re-reading the text, e.g. with `in_time_window` and `hourly_histogram`.
+
+Author: Richard Law
+Contact: richard.m.law@gmail.com
+'''
+
+import re
+
+import numpy as np
+
+# Confidence in a normalised time, from least to most
+TIME_UNKNOWN = 0
+TIME_VAGUE = 1  # A period of the day, like "evening"
+TIME_APPROXIMATE = 2  # A clock time, but "approx" or with a guessed am/pm
+TIME_EXACT = 3
+
+MINUTES_PER_DAY = 1440
+
+# Vague periods of the day, as (start, end) minutes
+PERIODS = {
+    'early morning': (300, 480),
+    'morning': (360, 720),
+    'early afternoon': (720, 900),
+    'late afternoon': (900, 1080),
+    'afternoon': (720, 1080),
+    'early evening': (1020, 1200),
+    'evening': (1080, 1320),
+    'twilight': (1080, 1260),
+    'daytime': (360, 1080),
+    'night': (1200, 360)
+}
+
+APPROXIMATE_WORDS = ['approx', 'around', 'about', 'just after', 'just before',
+                     'circa']
+
+# Either an hour with optional minutes ("9", "9.30"), or a 24 hour HHMM time
+# ("2130", "2130 hrs")
+TIME_RE = re.compile(
+    r'(?<![\d.:])(?:(?P<hour>\d{1,2})(?:\s?[.:]\s?(?P<minute>\d{2}))?|'
+    r'(?P<hour24>[01]\d|2[0-3])(?P<minute24>[0-5]\d)'
+    r'(?:\s?(?:hours|hrs|hr|h)\b)?)(?!\d)'
+    r'(?:\s*(?P<meridiem>[ap])\.?\s?m\b\.?)?')
+
+MONTHS = r'(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?'
+
+# A number followed by one of these is a duration or a date, not a time
+NOT_TIME_AFTER_RE = re.compile(
+    r'\s*(min|mins|minutes?|hours?|hrs?|secs?|seconds?|' + MONTHS + r')\b')
+
+# ...as is a number after a month
+NOT_TIME_BEFORE_RE = re.compile(r'\b' + MONTHS + r'\s*$')
+
+# What can come between the start and end times of a range
+RANGE_RE = re.compile(r'^\s*(-|&|to|and|till|until)\s*$')
+
+PERIOD_RE = re.compile('|'.join(
+    sorted(PERIODS.keys(), key=len, reverse=True)))
+
+# Results of `parse_time`, by raw time string; there are many repeats
+TIME_CACHE = {}
+
+
+def handle_special_time(time_string):
+    '''
+    A few times are written in a way that isn't worth teaching the parser.
+    Returns the best interpretation of <time_string> if it's one of them, as
+    something that can be parsed, otherwise returns <time_string>.
+    '''
+    exceptions = {
+        'approx. 10 minutes past midnight': 'approx 12.10 am'
+    }
+    return exceptions.get(time_string.strip().lower(), time_string)
+
+
+def clock_times(text):
+    '''
+    Returns the clock times in <text>, in order, as (minute of day, meridiem)
+    tuples, where the meridiem is 'a', 'p', or None if unstated (in which case
+    the minute of day is for "am", unless it's a 24 hour time).
+
+    Four digits are a 24 hour time ("2130", "2130 hrs"). Numbers that are
+    durations or dates ("for 5 mins", "15 Jan") are not clock times. Nor is a
+    bare number without am/pm after the first time, unless it ends a range
+    ("10 - 11", "between 10 and 11").
+    '''
+    times = []
+    previous_end = None
+    for match in TIME_RE.finditer(text):
+        meridiem = match.group('meridiem')
+        if match.group('hour24'):
+            hour, minute = int(match.group('hour24')), int(
+                match.group('minute24'))
+            meridiem = meridiem or ('p' if hour >= 12 else 'a')
+        else:
+            hour, minute = int(match.group('hour')), int(
+                match.group('minute') or 0)
+        if hour > 23 or minute > 59:
+            continue
+        if NOT_TIME_AFTER_RE.match(text[match.end():]) or \
+                NOT_TIME_BEFORE_RE.search(text[:match.start()]):
+            continue
+        if times and meridiem is None and not RANGE_RE.match(
+                text[previous_end:match.start()]):
+            continue
+        previous_end = match.end()
+        if hour > 12:
+            meridiem = 'p'
+        elif hour == 0:
+            meridiem = 'a'
+        times.append(((hour % 12) * 60 + minute, meridiem))
+    return times
+
+
+def is_clock_time(text):
+    '''
+    Returns True if <text> is nothing but a clock time with am or pm, e.g.
+    "12:00 am"
+    '''
+    text = text.strip().lower()
+    match = TIME_RE.match(text)
+    return bool(match and match.group('meridiem') and match.end() == len(text))
+
+
+def parse_time(time_string):
+    '''
+    Returns (start, end, confidence) for a raw time string: the minute of the
+    day the sighting started and ended, and one of TIME_UNKNOWN, TIME_VAGUE,
+    TIME_APPROXIMATE or TIME_EXACT. Results are cached by <time_string>.
+    '''
+    if time_string not in TIME_CACHE:
+        TIME_CACHE[time_string] = normalise_time(time_string)
+    return TIME_CACHE[time_string]
+
+
+def normalise_time(time_string):
+    '''
+    Does the work of `parse_time`, without the cache
+    '''
+    unknown = (-1, -1, TIME_UNKNOWN)
+    if not time_string:
+        return unknown
+    text = handle_special_time(time_string).lower()
+    for entity, char in [('&amp;', '&'), ('&ndash;', '-'), ('&nbsp;', ' '),
+                         ('–', '-'), ('—', '-')]:
+        text = text.replace(entity, char)
+    approximate = any(word in text for word in APPROXIMATE_WORDS)
+    # Bracketed asides are things like other time zones, or "(sunset)"
+    text = re.sub(r'\([^)]*\)', '', text)
+    text = re.sub(r'\bmidnight\b', '12 am', text)
+    text = re.sub(r'\b(noon|midday)\b', '12 pm', text)
+
+    times = clock_times(text)
+    if not times:
+        periods = [PERIODS[p] for p in PERIOD_RE.findall(text)]
+        if not periods:
+            return unknown
+        return periods[0][0], periods[-1][1], TIME_VAGUE
+
+    (start, start_meridiem), (end, end_meridiem) = times[0], times[-1]
+    if end_meridiem is None:
+        # Only one time, or no am/pm at the end: most sightings are at night
+        approximate = True
+        end_meridiem = start_meridiem or 'p'
+    if end_meridiem == 'p':
+        end += 720
+    if start_meridiem is None:
+        # Whichever of am or pm makes for the shorter sighting
+        start = min([start, start + 720],
+                    key=lambda s: (end - s) % MINUTES_PER_DAY)
+    elif start_meridiem == 'p':
+        start += 720
+    if len(times) == 1:
+        start = end
+    return start, end, TIME_APPROXIMATE if approximate else TIME_EXACT
+
+
+def in_time_window(starts, ends, window_start, window_end):
+    '''
+    Given arrays of normalised <starts> and <ends>, returns a boolean array of
+    which overlap the time of day from <window_start> to <window_end> (minutes
+    of the day; the window may cross midnight, e.g. 1260 to 120). Unknown
+    times are never in the window.
+    '''
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    wraps = starts > ends
+    # Split intervals that cross midnight in two; an empty second part has an
+    # end of -1
+    segments = [(starts, np.where(wraps, MINUTES_PER_DAY - 1, ends)),
+                (np.zeros_like(starts), np.where(wraps, ends, -1))]
+    if window_start > window_end:
+        windows = [(window_start, MINUTES_PER_DAY - 1), (0, window_end)]
+    else:
+        windows = [(window_start, window_end)]
+    found = np.zeros(len(starts), dtype=bool)
+    for low, high in segments:
+        for window_low, window_high in windows:
+            found |= (low <= window_high) & (window_low <= high)
+    return found & (starts >= 0)
+
+
+def hourly_histogram(starts):
+    '''
+    Returns the number of sightings starting in each hour of the day
+    '''
+    starts = np.asarray(starts)
+    return np.bincount(starts[starts >= 0] // 60, minlength=24)
@@ -1,6 +1,20 @@
 from nose.tools import *
 from PythonUFOCUSNZ import scrape
+from PythonUFOCUSNZ import flaps
+from PythonUFOCUSNZ import timeofday
+from PythonUFOCUSNZ import server
+import collections
 import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy
+import urllib2
+from cStringIO import StringIO
 
 def setup_module():
     pass
@@ -26,3 +40,430 @@ def test_sanity_check_first_2010_sighting():
     assert first_sighting.location.title() == "Tauranga, North Island"
     assert first_sighting.features.lower() == "red light travelling at high speed"
     assert "Three witnesses observed a red light pass over Mount Maunganui" in first_sighting.description
+
+def test_connected_components_long_chain():
+    # A long, shuffled chain of sightings is one flap, and labelling it must not
+    # take as many rounds as the chain is long
+    count = 100000
+    order = numpy.random.RandomState(0).permutation(count)
+    labels = flaps.connected_components(count, order[:-1], order[1:])
+    assert (labels == 0).all()
+
+def test_find_flaps_clustered():
+    # Regression test: a population-weighted distribution (30% of the
+    # sightings packed around Auckland) used to take one labelling round per
+    # step along the longest chain of sightings
+    rng = numpy.random.RandomState(1)
+    count, clustered = 30000, 9000
+    longitudes = numpy.concatenate([rng.uniform(166, 178, count - clustered),
+                                    rng.normal(174.76, 0.05, clustered)])
+    latitudes = numpy.concatenate([rng.uniform(-47, -34, count - clustered),
+                                   rng.normal(-36.85, 0.05, clustered)])
+    days = rng.randint(0, 365 * 6, count)
+    start = time.time()
+    found = flaps.find_flaps(longitudes, latitudes, days)
+    assert time.time() - start < 10
+    assert found.max() > 0
+    assert (found[count - clustered:] >= 0).mean() > 0.5
+
+def test_find_flaps_north_south():
+    # Three sightings on the same night, each 15 km south of the last
+    found = flaps.find_flaps([174.76] * 3, [-36.85, -36.985, -37.12], [1, 1, 1])
+    assert list(found) == [0, 0, 0]
+    # ...and the same east-west
+    found = flaps.find_flaps([174.76, 174.929, 175.098], [-36.85] * 3,
+                             [1, 1, 1])
+    assert list(found) == [0, 0, 0]
+
+def make_sighting(location, date, longitude, latitude, description='A light'):
+    # A geocoded UFOSighting, without scraping or geocoding anything
+    ufo = scrape.UFOSighting('http://example.com', date, '9 pm', location,
+                             'light', description)
+    ufo.haslocation = True
+    ufo.longitude, ufo.latitude = longitude, latitude
+    return ufo
+
+def test_flap_ids_are_stable():
+    # Flap ids must not depend on the order the sightings arrive in, nor on
+    # other flaps, or the change feed would see every member as modified
+    def sightings():
+        return [make_sighting('Auckland %d' % i, '%d May 2010' % (i + 1),
+                              174.76 + i * 0.01, -36.85) for i in range(3)] + \
+            [make_sighting('Wellington %d' % i, '%d June 2012' % (i + 1),
+                           174.77, -41.28 - i * 0.01) for i in range(3)] + \
+            [make_sighting('Invercargill', '1 July 2011', 168.35, -46.41)]
+    first = sightings()
+    first_flaps = flaps.detect_flaps(first)
+    second = sightings()[::-1] + [
+        make_sighting('Nelson %d' % i, '%d March 2009' % (i + 1), 173.28,
+                      -41.27) for i in range(3)]
+    second_flaps = flaps.detect_flaps(second)
+
+    assert len(first_flaps['features']) == 2
+    assert len(second_flaps['features']) == 3
+    by_location = {ufo.location: ufo.flap for ufo in second}
+    for ufo in first:
+        assert ufo.flap == by_location[ufo.location]
+    assert first[0].flap == first[0].identifier()
+    assert first[-1].flap == ''
+    assert set(f['id'] for f in first_flaps['features']) < \
+        set(f['id'] for f in second_flaps['features'])
+
+def test_normalise_time():
+    EXACT, APPROX = timeofday.TIME_EXACT, timeofday.TIME_APPROXIMATE
+    cases = {
+        '9.30 pm': (1290, 1290, EXACT),
+        'approx 9.30pm': (1290, 1290, APPROX),
+        '12:00 am': (0, 0, EXACT),
+        '12.30 pm': (750, 750, EXACT),
+        'between 10 and 10.30 pm': (1320, 1350, EXACT),
+        '5-6.30 am': (300, 390, EXACT),
+        '11.30-12.10am': (1410, 10, EXACT),
+        'between 11pm and 2 am': (1380, 120, EXACT),
+        'between 11.15 and midnight': (1395, 0, EXACT),
+        '2.15 am (05-9-2010 1645hrs UTC)': (135, 135, EXACT),
+        'Late afternoon/early evening': (900, 1200, timeofday.TIME_VAGUE),
+        'Unknown': (-1, -1, timeofday.TIME_UNKNOWN),
+        None: (-1, -1, timeofday.TIME_UNKNOWN),
+        # Durations, dates and stray numbers are not the end of the sighting
+        'approx 9pm for 5 mins': (1260, 1260, APPROX),
+        '10pm, lasted 2 hours': (1320, 1320, EXACT),
+        '7 pm 15 Jan': (1140, 1140, EXACT),
+        'about 20 minutes': (-1, -1, timeofday.TIME_UNKNOWN),
+        '9 pm till 10': (1260, 1320, APPROX),
+        '15 Jan 2010': (-1, -1, timeofday.TIME_UNKNOWN),
+        # 24 hour times
+        '2130': (1290, 1290, EXACT),
+        '2130 hrs': (1290, 1290, EXACT),
+        '0915hrs': (555, 555, EXACT),
+        'approx 2300h': (1380, 1380, APPROX),
+        '2345-0010 hours': (1425, 10, EXACT),
+        '1200 hrs for 2 hrs': (720, 720, EXACT)
+    }
+    for time_string, expected in cases.items():
+        assert_equal(timeofday.normalise_time(time_string), expected)
+
+def test_in_time_window():
+    # 21:00-21:30, 23:30-00:30 (crosses midnight), 10:00, unknown
+    starts = numpy.array([1260, 1410, 600, -1])
+    ends = numpy.array([1290, 30, 600, -1])
+    assert_equal(list(timeofday.in_time_window(starts, ends, 1200, 1320)),
+                 [True, False, False, False])
+    # Windows that cross midnight
+    assert_equal(list(timeofday.in_time_window(starts, ends, 1380, 120)),
+                 [False, True, False, False])
+    assert_equal(list(timeofday.in_time_window(starts, ends, 1275, 15)),
+                 [True, True, False, False])
+    assert_equal(list(timeofday.in_time_window(starts, ends, 20, 25)),
+                 [False, True, False, False])
+    assert_equal(list(timeofday.in_time_window(starts, ends, 0, 1439)),
+                 [True, True, True, False])
+
+def test_is_clock_time():
+    assert timeofday.is_clock_time('12:00 am')
+    assert timeofday.is_clock_time(' 9.30pm ')
+    assert timeofday.is_clock_time('10:45 p.m.')
+    assert not timeofday.is_clock_time('12')
+    assert not timeofday.is_clock_time('State Highway 1')
+    assert not timeofday.is_clock_time('9 pm, Tauranga')
+
+def test_parse_query_bbox():
+    for bbox in ['inf,0,1,1', 'nan,nan,nan,nan', '1,2,3', '2,0,1,1', 'a,b,c,d']:
+        assert_raises(ValueError, server.parse_query, 'bbox=' + bbox)
+    criteria, _ = server.parse_query('bbox=-100000,-90,100000,90')
+    assert_equal(criteria['bbox'], [-180, -90, 180, 90])
+
+def test_parse_query_time():
+    for time_range in ['25:00-02:00', '21:00-24:00', '21:60-02:00', '9pm-2am',
+                       '21:00']:
+        assert_raises(ValueError, server.parse_query, 'time=' + time_range)
+    criteria, _ = server.parse_query('time=21:00-2:30')
+    assert_equal(criteria['time_of_day'], [1260, 150])
+    criteria, _ = server.parse_query('time=00:00-23:59')
+    assert_equal(criteria['time_of_day'], [0, 1439])
+
+def test_dataset_in_bbox():
+    collection = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': str(i), 'properties': {},
+         'geometry': {'type': 'Point', 'coordinates': [lon, lat]}}
+        for i, (lon, lat) in enumerate([(174.76, -36.85), (174.77, -41.28)])
+    ]}
+    path = os.path.join(tempfile.mkdtemp(), 'ufos_data.geojson')
+    with open(path, 'w') as outfile:
+        json.dump(collection, outfile)
+    dataset = server.Dataset(path)
+    assert_equal(dataset.in_bbox(174, -37, 175, -36), set([0]))
+    # A bbox of the whole world looks at the occupied cells, not every cell
+    start = time.time()
+    assert_equal(dataset.in_bbox(-180, -90, 180, 90), set([0, 1]))
+    assert time.time() - start < 1
+
+def test_classify_location():
+    assert_equal(scrape.classify_location('Tauranga'), 'plain')
+    assert_equal(scrape.classify_location(None), 'plain')
+    assert_equal(scrape.classify_location('Takanini/Papakura, Auckland'),
+                 'slash')
+    assert_equal(scrape.classify_location('Manukau (near airport), Auckland'),
+                 'brackets')
+    assert_equal(scrape.classify_location('Tairua &amp; Pauanui'), 'ampersand')
+    assert_equal(scrape.classify_location('Tauranga, North Island'), 'island')
+    assert_equal(scrape.classify_location('between Taupo and Turangi'),
+                 'conjunction')
+    assert_equal(
+        scrape.classify_location('Waihi/Paeroa (Hauraki), North Island.'),
+        'slash+brackets+island')
+
+def test_order_geocode_strategies():
+    default = [name for name, _ in scrape.GEOCODE_STRATEGIES]
+    names = lambda stats, kind: [name for name, _ in
+                                 scrape.order_geocode_strategies(kind, stats)]
+    assert_equal(names({}, 'plain'), default)
+    stats = {'slash': {'substitutions': 1, 'slash': 4},
+             'plain': {'brackets': 2}}
+    assert_equal(names(stats, 'slash')[:2], ['slash', 'substitutions'])
+    assert_equal(names(stats, 'slash')[2:],
+                 [n for n in default if n not in ('slash', 'substitutions')])
+    assert_equal(names(stats, 'brackets'), default)
+
+class FakeNominatim(object):
+    # Knows only Mission Bay and Papakura
+    known = ['Mission Bay, Auckland, New Zealand',
+             'Papakura, Auckland, New Zealand']
+    def __init__(self, **kwargs):
+        pass
+    def geocode(self, location, exactly_one=True):
+        if location in self.known:
+            return collections.namedtuple(
+                'Location', 'latitude longitude')(-36.85, 174.83)
+        return None
+
+def test_geocode_credits_only_strategies_that_change_the_location():
+    nominatim = scrape.Nominatim
+    scrape.Nominatim = FakeNominatim
+    try:
+        # Geocodes on the first query, as is; title case must not take credit
+        ufo = make_sighting('Mission Bay, Auckland', '1 May 2010', None, None)
+        assert ufo.geocode(strategy_stats={'plain': {'title case': 3}})
+        assert_equal(ufo.geocoded_by, scrape.AS_IS)
+        assert_equal(len(ufo.already_attempted), 1)
+        ufo = make_sighting('Takanini/Papakura, Auckland', '1 May 2010', None,
+                            None)
+        assert ufo.geocode()
+        assert_equal(ufo.geocoded_by, 'slash')
+        stats = {}
+        scrape.record_geocode_strategy(stats, ufo)
+        assert_equal(stats, {'slash': {'slash': 1}})
+    finally:
+        scrape.Nominatim = nominatim
+
+def test_identifier_distinguishes_witnesses():
+    # Two reports of the same event, on the same page
+    first = make_sighting('Tauranga', '1 May 2010', 176.17, -37.69,
+                          description='I saw a red light')
+    second = make_sighting('Tauranga', '1 May 2010', 176.17, -37.69,
+                           description='We saw two red lights')
+    assert first.identifier() != second.identifier()
+    assert_equal(first.identifier(), make_sighting(
+        'Tauranga', '1 May 2010', 0, 0,
+        description='I saw a red light').identifier())
+
+def test_diff_feature_collections():
+    def collection(features):
+        return {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'id': key, 'properties': {'time': time},
+             'geometry': {'type': 'Point', 'coordinates': [174.0, -41.0]}}
+            for key, time in features
+        ]}
+    previous = collection([('a', '9 pm'), ('b', '10 pm'), ('c', '11 pm')])
+    current = collection([('a', '9 pm'), ('c', '11.30 pm'), ('d', '1 am')])
+    current['features'].append({'type': 'Feature', 'properties': {},
+                                'geometry': None})  # No id; ignored
+    added, removed, modified = scrape.diff_feature_collections(previous,
+                                                               current)
+    assert_equal([f['id'] for f in added], ['d'])
+    assert_equal(removed, ['b'])
+    assert_equal([f['id'] for f in modified], ['c'])
+    assert_equal(scrape.diff_feature_collections(current, current),
+                 ([], [], []))
+
+def test_read_geocode_journal_skips_torn_line():
+    ufo = make_sighting('Mission Bay, Auckland', '1 May 2010', 174.83, -36.85)
+    handle, path = tempfile.mkstemp(suffix='.jsonl')
+    try:
+        with os.fdopen(handle, 'w') as outfile:
+            scrape.append_to_geocode_journal(outfile, ufo)
+            outfile.write('{"id": "cut sh')  # A crash mid-write
+        assert_equal(scrape.read_geocode_journal(path).keys(),
+                     [ufo.identifier()])
+        # The torn line is terminated, so the next entry is a line of its own
+        with open(path, 'r') as infile:
+            assert infile.read().endswith('sh\n')
+        other = make_sighting('Papakura', '2 May 2010', 174.94, -37.06)
+        with open(path, 'a') as outfile:
+            scrape.append_to_geocode_journal(outfile, other)
+        assert_equal(sorted(scrape.read_geocode_journal(path).keys()),
+                     sorted([ufo.identifier(), other.identifier()]))
+    finally:
+        os.remove(path)
+
+class NoNominatim(object):
+    def __init__(self, **kwargs):
+        raise AssertionError('Geocoded a sighting that was in the journal')
+
+def test_geocode_with_journal_restores_without_geocoding():
+    ufo = make_sighting('Mission Bay, Auckland', '1 May 2010', 174.83, -36.85)
+    ufo.geocoded_to, ufo.geocoded_by = 'Mission Bay, Auckland', scrape.AS_IS
+    handle, path = tempfile.mkstemp(suffix='.jsonl')
+    nominatim = scrape.Nominatim
+    scrape.Nominatim = NoNominatim
+    try:
+        with os.fdopen(handle, 'w') as outfile:
+            scrape.append_to_geocode_journal(outfile, ufo)
+        fresh = scrape.UFOSighting('http://example.com', '1 May 2010', '9 pm',
+                                   'Mission Bay, Auckland', 'light', 'A light')
+        restored, = scrape.geocode_with_journal([fresh], path)
+        assert restored.haslocation
+        assert_equal((restored.longitude, restored.latitude), (174.83, -36.85))
+        assert_equal(restored.geocoded_by, scrape.AS_IS)
+    finally:
+        scrape.Nominatim = nominatim
+        os.remove(path)
+
+def test_geocode_with_journal_appends_each_result():
+    ufos = [scrape.UFOSighting('http://example.com', '1 May 2010', '9 pm',
+                               location, 'light', 'A light')
+            for location in ['Mission Bay, Auckland', 'Papakura, Auckland',
+                             'Nowhere']]
+    handle, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(handle)
+    lines_before = []
+    def append(journal_file, sighting):
+        # What a crash at this point would leave behind
+        with open(path, 'r') as infile:
+            lines_before.append(len(infile.readlines()))
+        append_to_geocode_journal(journal_file, sighting)
+    nominatim = scrape.Nominatim
+    append_to_geocode_journal = scrape.append_to_geocode_journal
+    scrape.Nominatim = FakeNominatim
+    scrape.append_to_geocode_journal = append
+    try:
+        results = scrape.geocode_with_journal(ufos, path)
+        assert_equal(lines_before, [0, 1, 2])
+        assert_equal(sorted(ufo.haslocation for ufo in results),
+                     [False, True, True])
+        assert_equal(sorted(scrape.read_geocode_journal(path).keys()),
+                     sorted(ufo.identifier() for ufo in ufos))
+    finally:
+        scrape.Nominatim = nominatim
+        scrape.append_to_geocode_journal = append_to_geocode_journal
+        os.remove(path)
+
+def test_export_ufos_to_geojson_never_overwrites_change_sets():
+    directory = tempfile.mkdtemp()
+    changes_dir = os.path.join(directory, 'ufos_data_changes')
+    geojson = os.path.join(directory, 'ufos_data.geojson')
+    try:
+        ufos = [make_sighting('Tauranga', '1 May 2010', 176.17, -37.69)]
+        scrape.export_ufos_to_geojson(ufos, directory)
+        scrape.export_ufos_to_geojson(ufos, directory)  # No changes
+        assert_equal(os.listdir(changes_dir), ['1.json'])
+        # Losing the GeoJSON mustn't restart the numbering
+        os.remove(geojson)
+        ufos.append(make_sighting('Papakura', '2 May 2010', 174.94, -37.06))
+        scrape.export_ufos_to_geojson(ufos, directory)
+        assert_equal(sorted(os.listdir(changes_dir)), ['1.json', '2.json'])
+        with open(os.path.join(changes_dir, '1.json'), 'r') as infile:
+            assert_equal(len(json.load(infile)['added']), 1)
+        with open(geojson, 'r') as infile:
+            assert_equal(json.load(infile)['sequence'], 2)
+    finally:
+        shutil.rmtree(directory)
+
+def write_collection(path, places):
+    # Atomically, as the exporter does
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'id': name,
+             'properties': {'location': name, 'date': '2010-05-01'},
+             'geometry': {'type': 'Point', 'coordinates': [lon, lat]}}
+            for name, lon, lat in places
+        ]}, outfile)
+    os.rename(path + '.tmp', path)
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = server.LRUCache(size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert_equal(cache.get('a'), 1)
+    cache.put('c', 3)
+    assert_equal(cache.get('b'), None)
+    assert_equal((cache.get('a'), cache.get('c')), (1, 3))
+
+def test_server_etag_and_gzip():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'ufos_data.geojson')
+    write_collection(path, [('Auckland', 174.76, -36.85),
+                            ('Wellington', 174.77, -41.28)])
+    sightings = server.SightingsServer(path, address=('127.0.0.1', 0))
+    thread = threading.Thread(target=sightings.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/sightings?q=auckland'.format(
+        sightings.server_address[1])
+    render = server.render
+    try:
+        response = urllib2.urlopen(url)
+        etag, body = response.info()['ETag'], response.read()
+        assert_equal(response.info().get('Content-Encoding'), None)
+        assert_equal([f['id'] for f in json.loads(body)['features']],
+                     ['Auckland'])
+
+        compressed = urllib2.urlopen(urllib2.Request(
+            url, headers={'Accept-Encoding': 'gzip'}))
+        assert_equal(compressed.info()['Content-Encoding'], 'gzip')
+        assert_equal(compressed.info()['ETag'], etag)
+        assert_equal(gzip.GzipFile(
+            fileobj=StringIO(compressed.read())).read(), body)
+
+        # Not modified, even once it has dropped out of the cache, without
+        # rendering it again
+        sightings.watcher.current.cache = server.LRUCache()
+        def fail(features, output_format):
+            raise AssertionError('Rendered a response the client has')
+        server.render = fail
+        try:
+            urllib2.urlopen(urllib2.Request(
+                url, headers={'If-None-Match': etag}))
+            assert False, 'Expected 304 Not Modified'
+        except urllib2.HTTPError, exc:
+            assert_equal(exc.code, 304)
+            assert_equal(exc.info()['ETag'], etag)
+    finally:
+        server.render = render
+        sightings.shutdown()
+        thread.join()
+        sightings.server_close()
+        shutil.rmtree(directory)
+
+def test_dataset_watcher_swaps_after_rename():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'ufos_data.geojson')
+    write_collection(path, [('Auckland', 174.76, -36.85)])
+    watcher = server.DatasetWatcher(path, interval=0.01)
+    watcher.start()
+    try:
+        old = watcher.current
+        write_collection(path, [('Auckland', 174.76, -36.85),
+                                ('Wellington', 174.77, -41.28)])
+        # Filesystems with coarse timestamps may not see the change otherwise
+        os.utime(path, (old.mtime + 10, old.mtime + 10))
+        deadline = time.time() + 5
+        while watcher.current is old and time.time() < deadline:
+            time.sleep(0.01)
+        assert_equal(len(watcher.current.features), 2)
+        assert_equal(len(old.features), 1)
+        assert watcher.current.version != old.version
+    finally:
+        watcher.stopped.set()
+        watcher.join()
+        shutil.rmtree(directory)